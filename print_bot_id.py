@@ -6,7 +6,7 @@ load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
 BOT_NAME = 'souschef'
 
-print os.environ.get('SLACK_BOT_TOKEN')
+print(os.environ.get('SLACK_BOT_TOKEN'))
 
 slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
 
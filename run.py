@@ -1,3 +1,4 @@
+import logging
 import os
 import sys
 
@@ -15,6 +16,8 @@ if __name__ == "__main__":
     try:
         # load environment variables
         load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+        # configure logging (DEBUG enables the per-query/vertex messages)
+        logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
         slack_bot_id = os.environ.get("SLACK_BOT_ID")
         slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
         conversation_workspace_id = os.environ.get("CONVERSATION_WORKSPACE_ID")
@@ -1,4 +1,5 @@
 import deployment_tracker
+import logging
 import os
 
 from dotenv import load_dotenv
@@ -11,24 +12,39 @@ from souschef.recipe import RecipeClient
 from souschef.sns_client import SNSClient
 from souschef.souschef import SousChef
 
-try:
-    from SimpleHTTPServer import SimpleHTTPRequestHandler as Handler
-    from SocketServer import TCPServer as Server
-except ImportError:
-    from http.server import SimpleHTTPRequestHandler as Handler
-    from http.server import HTTPServer as Server
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Answers the Cloud Foundry health check; everything else is a 404."""
+
+    def do_GET(self):
+        if self.path == '/health':
+            body = b'OK'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        # keep health-check probes out of the logs
+        pass
 
 # Read port selected by the cloud for our application
 PORT = int(os.getenv('PORT', 8000))
-# Change current directory to avoid exposure of control files
-os.chdir('static')
 
-httpd = Server(("", PORT), Handler)
+httpd = HTTPServer(("", PORT), HealthHandler)
 try:
     # track deployment
     deployment_tracker.track()
     # load environment variables
     load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    # configure logging (DEBUG enables the per-query/vertex messages)
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
     slack_bot_id = os.environ.get("SLACK_BOT_ID")
     slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
     conversation_workspace_id = os.environ.get("CONVERSATION_WORKSPACE_ID")
@@ -60,7 +76,7 @@ try:
                         sns_client)
     souschef.start()
     # start the http server
-    print("Start serving at port %i" % PORT)
+    logging.info("Start serving at port %i", PORT)
     httpd.serve_forever()
 except (KeyboardInterrupt, SystemExit):
     pass
@@ -1,4 +1,18 @@
 import json
+import logging
+
+from collections import OrderedDict
+from functools import lru_cache
+
+try:
+    # orjson serializes in native code, 2-5x faster on large recipe payloads
+    import orjson
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj)
 
 from ibm_graph import Edge
 from ibm_graph import Vertex
@@ -8,6 +22,44 @@ from ibm_graph.schema import Schema
 from ibm_graph.schema import VertexIndex
 from ibm_graph.schema import VertexLabel
 
+_log = logging.getLogger(__name__)
+
+# Gremlin query templates, built once and reused with bindings so the query
+# string stays identical across invocations and the server can cache the
+# compiled execution plan.
+_Q_FIND_VERTEX = 'g.V().hasLabel(vlabel).has(pname, pvalue)'
+_Q_FIND_EDGE = 'g.V(outId).outE().inV().hasId(inId).path()'
+_Q_FAVORITES = 'g.V().hasLabel("person").has("name", uname)' \
+               '.outE().order().by("count", decr)' \
+               '.inV().hasLabel("recipe").limit(cnt)'
+_Q_RECOMMENDED = 'g.V().hasLabel(vlabel).has("name", vname)' \
+                 '.in("has").as("recipe")' \
+                 '.inE().has("count", gt(1))' \
+                 '.outV().hasLabel("person").has("name", neq(uname))' \
+                 '.select("recipe").groupCount()' \
+                 '.unfold().order().by(values, decr).limit(cnt)' \
+                 '.project("id", "title", "recommendedUserCount")' \
+                 '.by(select(keys).values("name"))' \
+                 '.by(select(keys).values("title"))' \
+                 '.by(select(values))'
+# upserts the user->recipe and ingredient/cuisine->recipe "selects" edges
+# (bumping the count) and the recipe->ingredient/cuisine "has" edge in a
+# single round trip
+_Q_RECORD_RECIPE = 'def bump = { outId, inId ->' \
+                   ' def t = g.V(outId).outE("selects").filter(inV().hasId(inId));' \
+                   ' if (t.hasNext()) { def e = t.next(); e.property("count", e.property("count").orElse(0) + 1) }' \
+                   ' else { g.V(outId).next().addEdge("selects", g.V(inId).next(), "count", 1) } };' \
+                   'bump(uid, rid);' \
+                   'bump(icid, rid);' \
+                   'if (!g.V(rid).outE("has").filter(inV().hasId(icid)).hasNext())' \
+                   ' { g.V(rid).next().addEdge("has", g.V(icid).next()) };' \
+                   '[]'
+# creates the edge or bumps its count in one request, returning just the
+# new count instead of a full path with both vertex payloads
+_Q_ADD_UPDATE_EDGE = 'def t = g.V(outId).outE(elabel).filter(inV().hasId(inId));' \
+                     'if (t.hasNext()) { def e = t.next(); def c = e.property("count").orElse(0) + 1; e.property("count", c); c }' \
+                     'else { g.V(outId).next().addEdge(elabel, g.V(inId).next(), "count", 1); 1 }'
+
 
 class GraphRecipeStore(object):
 
@@ -21,25 +73,27 @@ class GraphRecipeStore(object):
         """
         self.graph_client = graph_client
         self.graph_id = graph_id
+        self.vertex_cache = OrderedDict()
+        self.vertex_cache_size = 4096
 
     def init(self):
         """
         Creates and initializes the Graph and Graph schema.
         """
-        print('Getting graphs...')
+        _log.info('Getting graphs...')
         graph_ids = self.graph_client.get_graphs()
         graph_exists = (self.graph_id in graph_ids)
         if not graph_exists:
-            print('Creating graph {}...'.format(self.graph_id))
+            _log.info('Creating graph %s...', self.graph_id)
             self.graph_client.create_graph(self.graph_id)
         # set graph
         self.graph_client.set_graph(self.graph_id)
         # create schema if not exists
-        print('Getting graph schema...')
+        _log.info('Getting graph schema...')
         schema = self.graph_client.get_schema()
         schema_exists = (schema is not None and schema.property_keys is not None and len(schema.property_keys) > 0)
         if not schema_exists:
-            print('Creating graph schema...')
+            _log.info('Creating graph schema...')
             schema = Schema([
                     PropertyKey('name', 'String', 'SINGLE'),
                     PropertyKey('title', 'String', 'SINGLE'),
@@ -55,13 +109,14 @@ class GraphRecipeStore(object):
                     EdgeLabel('selects')
                 ],
                 [
-                    VertexIndex('vertexByName', ['name'], True, True)
+                    VertexIndex('vertexByName', ['name'], True, True),
+                    VertexIndex('vertexByTitle', ['title'], True, False)
                 ],
                 []
             )
             self.graph_client.save_schema(schema)
         else:
-            print('Graph Schema exists.')
+            _log.info('Graph Schema exists.')
 
     # User
 
@@ -80,6 +135,7 @@ class GraphRecipeStore(object):
     # Ingredients
 
     @staticmethod
+    @lru_cache(maxsize=1024)
     def get_unique_ingredients_name(ingredients_str):
         """
         Gets the unique name for the ingredient to be stored in Graph.
@@ -111,7 +167,7 @@ class GraphRecipeStore(object):
         """
         ingredient_vertex = Vertex('ingredient', {
             'name': self.get_unique_ingredients_name(ingredients_str),
-            'detail': json.dumps(matching_recipes)
+            'detail': _json_dumps(matching_recipes)
         })
         ingredient_vertex = self.add_vertex_if_not_exists(ingredient_vertex, 'name')
         self.record_ingredient_request_for_user(ingredient_vertex, user_vertex)
@@ -134,6 +190,7 @@ class GraphRecipeStore(object):
     # Cuisine
 
     @staticmethod
+    @lru_cache(maxsize=1024)
     def get_unique_cuisine_name(cuisine):
         """
         Gets the unique name for the cuisine to be stored in Graph.
@@ -163,7 +220,7 @@ class GraphRecipeStore(object):
         """
         cuisine_vertex = Vertex('cuisine', {
             'name': self.get_unique_cuisine_name(cuisine_str),
-            'detail': json.dumps(matching_recipes)
+            'detail': _json_dumps(matching_recipes)
         })
         cuisine_vertex = self.add_vertex_if_not_exists(cuisine_vertex, 'name')
         self.record_cuisine_request_for_user(cuisine_vertex, user_vertex)
@@ -186,6 +243,7 @@ class GraphRecipeStore(object):
     # Recipe
 
     @staticmethod
+    @lru_cache(maxsize=1024)
     def get_unique_recipe_name(recipe_id):
         """
         Gets the unique name for the recipe to be stored in Graph.
@@ -232,8 +290,10 @@ class GraphRecipeStore(object):
         user_vertex - The existing Graph vertex for the user
         count - The max number of recipes to return
         """
-        query = 'g.V().hasLabel("person").has("name", "{}").outE().order().by("count", decr).inV().hasLabel("recipe").limit({})'.format(user_vertex.get_property_value('name'), count)
-        recipe_vertices = self.graph_client.run_gremlin_query(query)
+        recipe_vertices = self.graph_client.run_gremlin_query(_Q_FAVORITES, bindings={
+            'uname': user_vertex.get_property_value('name'),
+            'cnt': count
+        })
         if len(recipe_vertices) > 0:
             recipes = []
             for recipe_vertex in recipe_vertices:
@@ -254,13 +314,13 @@ class GraphRecipeStore(object):
         user_vertex - The Graph vertex for the user requesting recommended recipes
         count - The max number of recipes to return
         """
-        ingredients_str = self.get_unique_ingredients_name(ingredients_str)
-        query = 'g.V().hasLabel("ingredient").has("name","{}")'.format(ingredients_str)
-        query += '.in("has")'
-        query += '.inE().has("count",gt(1)).order().by("count", decr)'
-        query += '.outV().hasLabel("person").has("name",neq("{}"))'.format(user_vertex.get_property_value('name'))
-        query += '.path()'
-        return self.get_recommended_recipes(query, count)
+        bindings = {
+            'vlabel': 'ingredient',
+            'vname': self.get_unique_ingredients_name(ingredients_str),
+            'uname': user_vertex.get_property_value('name'),
+            'cnt': count
+        }
+        return self.get_recommended_recipes(_Q_RECOMMENDED, bindings)
 
     def find_recommended_recipes_for_cuisine(self, cuisine, user_vertex, count):
         """
@@ -271,36 +331,26 @@ class GraphRecipeStore(object):
         user_vertex - The Graph vertex for the user requesting recommended recipes
         count - The max number of recipes to return
         """
-        cuisine = self.get_unique_cuisine_name(cuisine)
-        query = 'g.V().hasLabel("cuisine").has("name","{}")'.format(cuisine)
-        query += '.in("has")'
-        query += '.inE().has("count",gt(1)).order().by("count", decr)'
-        query += '.outV().hasLabel("person").has("name",neq("{}"))'.format(user_vertex.get_property_value('name'))
-        query += '.path()'
-        return self.get_recommended_recipes(query, count)
-
-    def get_recommended_recipes(self, query, count):
-        paths = self.graph_client.run_gremlin_query(query)
-        if len(paths) > 0:
-            recipes = []
-            for path in paths:
-                recipe_vertex = path.objects[1]
-                recipe_id = recipe_vertex.get_property_value('name')
-                existing_recipes = list(filter(lambda x: x['id'] == recipe_id, recipes))
-                if len(existing_recipes) == 0:
-                    if len(recipes) >= count:
-                        continue
-                    else:
-                        recipes.append({
-                            'id': recipe_id,
-                            'title': recipe_vertex.get_property_value('title'),
-                            'recommendedUserCount': 1
-                        })
-                else:
-                    existing_recipes[0]['recommendedUserCount'] += 1
-            return recipes
-        else:
-            return []
+        bindings = {
+            'vlabel': 'cuisine',
+            'vname': self.get_unique_cuisine_name(cuisine),
+            'uname': user_vertex.get_property_value('name'),
+            'cnt': count
+        }
+        return self.get_recommended_recipes(_Q_RECOMMENDED, bindings)
+
+    def get_recommended_recipes(self, query, bindings):
+        # the query dedupes, counts the recommending users, orders, and limits
+        # server-side, so all that is left is mapping the projected rows
+        results = self.graph_client.run_gremlin_query(query, bindings=bindings)
+        recipes = []
+        for result in results:
+            recipes.append({
+                'id': result['id'],
+                'title': result['title'],
+                'recommendedUserCount': result['recommendedUserCount']
+            })
+        return recipes
 
     def record_recipe_request_for_user(self, recipe_vertex, ingredient_cuisine_vertex, user_vertex):
         """
@@ -314,35 +364,74 @@ class GraphRecipeStore(object):
         ingredient_cuisine_vertex - The existing Graph vertex for either the ingredient or cuisine selected before the recipe
         user_vertex - The existing Graph vertex for the user
         """
-        # add one edge from the user to the recipe (this will let us find a user's favorite recipes, etc)
-        edge = Edge('selects', user_vertex.id, recipe_vertex.id, {
-            'count': 1
-        })
-        self.add_update_edge(edge)
         if ingredient_cuisine_vertex is not None:
-            # add "selects" edge from ingredient/cuisine to recipe
-            edge = Edge('selects', ingredient_cuisine_vertex.id, recipe_vertex.id, {
+            # create/update the user->recipe and ingredient/cuisine->recipe "selects" edges
+            # (these will let us find a user's favorite recipes, recommended recipes, etc)
+            # and the recipe->ingredient/cuisine "has" edge in a single Gremlin request
+            self.graph_client.run_gremlin_query(_Q_RECORD_RECIPE, bindings={
+                'uid': user_vertex.id,
+                'icid': ingredient_cuisine_vertex.id,
+                'rid': recipe_vertex.id
+            })
+        else:
+            # add one edge from the user to the recipe (this will let us find a user's favorite recipes, etc)
+            edge = Edge('selects', user_vertex.id, recipe_vertex.id, {
                 'count': 1
             })
             self.add_update_edge(edge)
-            # add "has" edge from recipe to ingredient/cuisine
-            edge = Edge('has', recipe_vertex.id, ingredient_cuisine_vertex.id)
-            self.add_edge_if_not_exists(edge)
 
     # Graph Helper Methods
 
+    def _get_cached_vertex(self, cache_key):
+        """
+        Gets the vertex cached under the specified key, or None if it has not been cached.
+        Promotes the vertex to most recently used when found.
+        Parameters
+        ----------
+        cache_key - The (label, property_name, property_value) tuple identifying the vertex
+        """
+        vertex = self.vertex_cache.get(cache_key)
+        if vertex is not None:
+            # move to the end, so the least recently used entries are evicted first
+            self.vertex_cache.pop(cache_key)
+            self.vertex_cache[cache_key] = vertex
+        return vertex
+
+    def _cache_vertex(self, cache_key, vertex):
+        """
+        Caches the specified vertex, evicting the least recently used entry when the cache is full.
+        Parameters
+        ----------
+        cache_key - The (label, property_name, property_value) tuple identifying the vertex
+        vertex - The vertex returned from Graph
+        """
+        if cache_key in self.vertex_cache:
+            self.vertex_cache.pop(cache_key)
+        elif len(self.vertex_cache) >= self.vertex_cache_size:
+            self.vertex_cache.popitem(last=False)
+        self.vertex_cache[cache_key] = vertex
+
     def find_vertex(self, label, property_name, property_value):
         """
         Finds a vertex based on the specified label, property_name, and property_value.
+        Checks the in-memory vertex cache first, so repeat lookups skip the Gremlin round trip.
         Parameters
         ----------
         label - The label value of the vertex stored in Graph
         property_name - The property name to search for
         property_value - The value that should match for the specified property name
         """
-        query = 'g.V().hasLabel("{}").has("{}", "{}")'.format(label, property_name, property_value)
-        response = self.graph_client.run_gremlin_query(query)
+        cache_key = (label, property_name, property_value)
+        vertex = self._get_cached_vertex(cache_key)
+        if vertex is not None:
+            return vertex
+        response = self.graph_client.run_gremlin_query(_Q_FIND_VERTEX, bindings={
+            'vlabel': label,
+            'pname': property_name,
+            'pvalue': property_value
+        })
         if len(response) > 0:
+            self._cache_vertex(cache_key, response[0])
             return response[0]
         else:
             return None
@@ -350,20 +439,41 @@ class GraphRecipeStore(object):
     def add_vertex_if_not_exists(self, vertex, unique_property_name):
         """
         Adds a new vertex to Graph if a vertex with the same value for unique_property_name does not exist.
+        The lookup and the add are fused into a single coalesce traversal, so either branch costs one round trip.
+        Previously seen vertices are served from the in-memory vertex cache without any round trip.
         Parameters
         ----------
         vertex - The vertex to add
         unique_property_name - The name of the property used to search for an existing vertex (the value will be extracted from the vertex provided)
         """
         property_value = vertex.get_property_value(unique_property_name)
-        query = 'g.V().hasLabel("{}").has("{}", "{}")'.format(vertex.label, unique_property_name, property_value)
-        response = self.graph_client.run_gremlin_query(query)
-        if len(response) > 0:
-            print('Returning {} vertex where {}={}'.format(vertex.label, unique_property_name, property_value))
-            return response[0]
-        else:
-            print('Creating {} vertex where {}={}'.format(vertex.label, unique_property_name, property_value))
-            return self.graph_client.add_vertex(vertex)
+        cache_key = (vertex.label, unique_property_name, property_value)
+        cached_vertex = self._get_cached_vertex(cache_key)
+        if cached_vertex is not None:
+            return cached_vertex
+        _log.debug('Ensuring %s vertex where %s=%s', vertex.label, unique_property_name, property_value)
+        bindings = {
+            'vlabel': vertex.label,
+            'pname': unique_property_name,
+            'pvalue': property_value
+        }
+        add_step = 'addV(vlabel).property(pname, pvalue)'
+        # bind the remaining vertex properties so the new vertex is complete
+        # (sorted, so the query string is stable and the server plan cache hits)
+        extra = 0
+        for property_name in sorted(vertex.properties):
+            if property_name == unique_property_name:
+                continue
+            name_binding = 'pname{}'.format(extra)
+            value_binding = 'pvalue{}'.format(extra)
+            bindings[name_binding] = property_name
+            bindings[value_binding] = vertex.get_property_value(property_name)
+            add_step += '.property({}, {})'.format(name_binding, value_binding)
+            extra += 1
+        query = 'g.V().hasLabel(vlabel).has(pname, pvalue).fold().coalesce(unfold(), {})'.format(add_step)
+        response = self.graph_client.run_gremlin_query(query, bindings=bindings)
+        self._cache_vertex(cache_key, response[0])
+        return response[0]
 
     def add_edge_if_not_exists(self, edge):
         """
@@ -372,33 +482,29 @@ class GraphRecipeStore(object):
         ----------
         edge - The edge to add
         """
-        query = 'g.V({}).outE().inV().hasId({}).path()'.format(edge.out_v, edge.in_v)
-        response = self.graph_client.run_gremlin_query(query)
+        response = self.graph_client.run_gremlin_query(_Q_FIND_EDGE, bindings={
+            'outId': edge.out_v,
+            'inId': edge.in_v
+        })
         if len(response) > 0:
-            print('Edge from {} to {} exists.'.format(edge.out_v, edge.in_v))
+            _log.debug('Edge from %s to %s exists.', edge.out_v, edge.in_v)
         else:
-            print('Creating edge from {} to {}'.format(edge.out_v, edge.in_v))
+            _log.debug('Creating edge from %s to %s', edge.out_v, edge.in_v)
             self.graph_client.add_edge(edge)
 
     def add_update_edge(self, edge):
         """
         Adds a new edge to Graph if an edge with the same out_v and in_v does not exist.
         Increments the count property on the edge.
+        The existence check, increment, and add are fused into a single Gremlin request
+        that returns only the new count.
         Parameters
         ----------
         edge - The edge to add
         """
-        query = 'g.V({}).outE().inV().hasId({}).path()'.format(edge.out_v, edge.in_v)
-        response = self.graph_client.run_gremlin_query(query)
-        if len(response) > 0:
-            print('Edge from {} to {} exists.'.format(edge.out_v, edge.in_v))
-            edge = response[0].objects[1]
-            edge_count = edge.get_property_value('count')
-            count = 0
-            if edge_count is not None:
-                count += edge_count
-            edge.set_property_value('count', count+1)
-            self.graph_client.update_edge(edge)
-        else:
-            print('Creating edge from {} to {}'.format(edge.out_v, edge.in_v))
-            self.graph_client.add_edge(edge)
+        _log.debug('Upserting %s edge from %s to %s', edge.label, edge.out_v, edge.in_v)
+        self.graph_client.run_gremlin_query(_Q_ADD_UPDATE_EDGE, bindings={
+            'elabel': edge.label,
+            'outId': edge.out_v,
+            'inId': edge.in_v
+        })
@@ -1,14 +1,47 @@
 import requests
 import json, os
+from threading import Lock
+from cachetools import TTLCache
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 class RecipeClient:
   def __init__(self, api_key):
     self. endpoint = \
       'https://spoonacular-recipe-food-nutrition-v1.p.mashape.com/'
     self.api_key = api_key
+    # one pooled session so repeat calls reuse the TCP+TLS connection
+    # instead of paying a fresh handshake per request
+    self.session = requests.Session()
+    self.session.mount('https://', HTTPAdapter(
+      pool_connections=4,
+      pool_maxsize=4,
+      max_retries=Retry(total=3, backoff_factor=0.3)
+    ))
+    # Spoonacular responses don't change within a session window, so cache
+    # them for an hour to save round trips and API quota; TTLCache is not
+    # thread-safe and the bot fetches info/steps concurrently, so guard it
+    self.cache = TTLCache(maxsize=2048, ttl=3600)
+    self.cache_lock = Lock()
+
+  def _get_cached(self, key, fetch):
+    with self.cache_lock:
+      try:
+        return self.cache[key]
+      except KeyError:
+        pass
+    # fetch outside the lock so concurrent requests still overlap
+    value = fetch()
+    with self.cache_lock:
+      self.cache[key] = value
+    return value
 
   def find_by_ingredients(self, ingredients):
+    return self._get_cached(('find_by_ingredients', ingredients),
+                            lambda: self._fetch_by_ingredients(ingredients))
+
+  def _fetch_by_ingredients(self, ingredients):
     url = self.endpoint + 'recipes/findByIngredients'
 
     params = {
@@ -24,9 +57,13 @@ class RecipeClient:
       "Accept": "application/json"
     }
 
-    return requests.get(url, params=params, headers=headers).json()
+    return self.session.get(url, params=params, headers=headers).json()
 
   def find_by_cuisine(self, cuisine):
+    return self._get_cached(('find_by_cuisine', cuisine),
+                            lambda: self._fetch_by_cuisine(cuisine))
+
+  def _fetch_by_cuisine(self, cuisine):
     url = self.endpoint + "recipes/search"
 
     payload = {
@@ -36,20 +73,28 @@ class RecipeClient:
     }
     headers={ 'X-Mashape-Key': self.api_key }
 
-    return requests.get(url, 
-                        params=payload, 
-                        headers=headers).json()['results']
+    return self.session.get(url,
+                            params=payload,
+                            headers=headers).json()['results']
 
   def get_info_by_id(self, id):
+    return self._get_cached(('get_info_by_id', id),
+                            lambda: self._fetch_info_by_id(id))
+
+  def _fetch_info_by_id(self, id):
     url = self.endpoint + "recipes/" + str(id) + "/information"
     params = {'includeNutrition': False }
     headers = {'X-Mashape-Key': self.api_key}
 
-    return requests.get(url, params=params, headers=headers).json()
+    return self.session.get(url, params=params, headers=headers).json()
 
   def get_steps_by_id(self, id):
+    return self._get_cached(('get_steps_by_id', id),
+                            lambda: self._fetch_steps_by_id(id))
+
+  def _fetch_steps_by_id(self, id):
     url = self.endpoint + "recipes/" + str(id) + "/analyzedInstructions"
     params = {'stepBreakdown': True}
     headers={'X-Mashape-Key': self.api_key}
 
-    return requests.get(url, params=params, headers=headers).json()
+    return self.session.get(url, params=params, headers=headers).json()
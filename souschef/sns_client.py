@@ -1,10 +1,12 @@
-import httplib
+import http.client
 import json
-import sys
+import logging
 
-from Queue import Queue
+from queue import Queue
 from threading import Thread
 
+_log = logging.getLogger(__name__)
+
 
 class SNSClient(object):
 
@@ -80,14 +82,14 @@ class SNSClient(object):
                 body = self.queue.get()
                 self.do_http_post('/notification', body)
             except Exception:
-                print(sys.exc_info())
+                _log.exception('Error posting notification')
             self.queue.task_done()
 
     def do_http_post(self, path, body=''):
         return self.do_http_post_url('/{}{}'.format(self.api_key, path), body)
 
     def do_http_post_url(self, url, body=''):
-        conn = httplib.HTTPConnection(self.base_url)
+        conn = http.client.HTTPConnection(self.base_url)
         conn.request('POST', url, body, headers={
             'Content-Type': 'application/json',
             'Accept': 'application/json'
@@ -1,10 +1,25 @@
+import atexit
 import json
-import pprint
-import sys
-import time
+import logging
+import select
+import shelve
 import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # orjson parses in native code, much faster on large stored recipe lists
+    import orjson
+
+    def _json_loads(s):
+        return orjson.loads(s)
+except ImportError:
+    _json_loads = json.loads
+
 from .user_state import UserState
 
+_log = logging.getLogger(__name__)
+
 
 class SousChef(threading.Thread):
 
@@ -20,20 +35,42 @@ class SousChef(threading.Thread):
         self.sns_client = sns_client
         #
         self.at_bot = "<@" + slack_bot_id + ">:"
-        self.delay = 0.5  # second
+        self.delay = 1.0  # seconds to block on the websocket before re-checking self.running
+        # load user state persisted by a previous run, so returning users
+        # don't trigger a Graph lookup on their first message after a restart;
+        # a corrupt db or stale entries that no longer unpickle must not keep
+        # the bot from starting, so fall back to an empty map
+        self.user_state_shelf = None
         self.user_state_map = {}
-        self.pp = pprint.PrettyPrinter(indent=4)
+        try:
+            self.user_state_shelf = shelve.open('state.db')
+            atexit.register(self.user_state_shelf.close)
+            self.user_state_map = dict(self.user_state_shelf)
+        except Exception:
+            _log.exception('Error loading persisted user state; starting with an empty map')
+        # pool for issuing independent API calls concurrently
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        # conversation context flag -> handler, checked in priority order
+        self.context_handlers = (
+            ('is_favorites', lambda state, message: self.handle_favorites_message(state)),
+            ('is_ingredients', self.handle_ingredients_message),
+            ('is_selection', lambda state, message: self.handle_selection_message(state))
+        )
         # constants
         self.MAX_RECIPES = 5
 
     def parse_slack_output(self, slack_rtm_output):
         output_list = slack_rtm_output
-        if output_list and len(output_list) > 0:
+        if output_list:
             for output in output_list:
-                if output and 'text' in output and 'user_profile' not in output and self.at_bot in output['text']:
-                    return output['text'].split(self.at_bot)[1].strip().lower(), output['user'], output['channel']
-                elif output and 'text' in output and 'user_profile' not in output:
-                    return output['text'].lower(), output['user'], output['channel']
+                if output and 'text' in output and 'user_profile' not in output:
+                    # fetch the text once; split(..., 1) stops after the first
+                    # mention, so if the bot is mentioned again later the rest
+                    # of the message is kept rather than truncated there
+                    text = output['text']
+                    if self.at_bot in text:
+                        return text.split(self.at_bot, 1)[1].strip().lower(), output['user'], output['channel']
+                    return text.lower(), output['user'], output['channel']
         return None, None, None
 
     def post_to_slack(self, response, channel):
@@ -42,11 +79,9 @@ class SousChef(threading.Thread):
     def handle_message(self, message, message_sender, channel):
         try:
             # get or create state for the user
-            if message_sender in self.user_state_map.keys():
-                state = self.user_state_map[message_sender]
-            else:
-                state = UserState(message_sender)
-                self.user_state_map[message_sender] = state
+            state = self.user_state_map.get(message_sender)
+            if state is None:
+                state = self.user_state_map[message_sender] = UserState(message_sender)
             # send message to watson conversation
             watson_response = self.conversation_client.message(
                 workspace_id=self.conversation_workspace_id,
@@ -56,22 +91,29 @@ class SousChef(threading.Thread):
             # update conversation context
             state.conversation_context = watson_response['context']
             # route response
-            if 'is_favorites' in state.conversation_context.keys() and state.conversation_context['is_favorites']:
-                response = self.handle_favorites_message(state)
-            elif 'is_ingredients' in state.conversation_context.keys() and state.conversation_context['is_ingredients']:
-                response = self.handle_ingredients_message(state, message)
-            elif 'is_selection' in state.conversation_context.keys() and state.conversation_context['is_selection']:
-                response = self.handle_selection_message(state)
-            elif watson_response['entities'] and watson_response['entities'][0]['entity'] == 'cuisine':
-                cuisine = watson_response['entities'][0]['value']
-                response = self.handle_cuisine_message(state, cuisine)
-            else:
-                response = self.handle_start_message(state, watson_response)
+            context = state.conversation_context
+            response = None
+            for flag, handler in self.context_handlers:
+                if context.get(flag):
+                    response = handler(state, message)
+                    break
+            if response is None:
+                if watson_response['entities'] and watson_response['entities'][0]['entity'] == 'cuisine':
+                    cuisine = watson_response['entities'][0]['value']
+                    response = self.handle_cuisine_message(state, cuisine)
+                else:
+                    response = self.handle_start_message(state, watson_response)
         except Exception:
-            print(sys.exc_info())
+            _log.exception('Error handling message')
             # clear state and set response
             self.clear_user_state(state)
             response = "Sorry, something went wrong! Say anything to me to start over..."
+        # persist the updated state so it survives a restart
+        if self.user_state_shelf is not None:
+            try:
+                self.user_state_shelf[message_sender] = state
+            except Exception:
+                _log.exception('Error persisting state for %s', message_sender)
         # post response to slack
         self.post_to_slack(response, channel)
 
@@ -105,7 +147,7 @@ class SousChef(threading.Thread):
         ingredients_str = message
         ingredient = self.recipe_store.find_ingredient(ingredients_str)
         if ingredient is not None:
-            print("Ingredient exists for {}. Returning recipes from datastore.".format(ingredients_str))
+            _log.debug('Ingredient exists for %s. Returning recipes from datastore.', ingredients_str)
             # get recipes from datastore
             matching_recipes = []
             recipe_ids = []
@@ -116,7 +158,7 @@ class SousChef(threading.Thread):
                 recipe_ids.append(recipe['id'])
                 matching_recipes.append(recipe)
             if len(matching_recipes) < self.MAX_RECIPES:
-                recipes = json.loads(ingredient.get_property_value('detail'))
+                recipes = _json_loads(ingredient.get_property_value('detail'))
                 for recipe in recipes:
                     recipe_id = str(recipe['id'])
                     if recipe_id not in recipe_ids:
@@ -128,7 +170,7 @@ class SousChef(threading.Thread):
             self.recipe_store.record_ingredient_request_for_user(ingredient, state.user)
         else:
             # we don't have the ingredients in our datastore yet, so get list of recipes from Spoonacular
-            print("Ingredient does not exist for {}. Querying Spoonacular for recipes.".format(ingredients_str))
+            _log.debug('Ingredient does not exist for %s. Querying Spoonacular for recipes.', ingredients_str)
             matching_recipes = self.recipe_client.find_by_ingredients(ingredients_str)
             # add ingredient to datastore
             ingredient = self.recipe_store.add_ingredient(ingredients_str, matching_recipes, state.user)
@@ -146,7 +188,7 @@ class SousChef(threading.Thread):
         cuisine_str = message
         cuisine = self.recipe_store.find_cuisine(cuisine_str)
         if cuisine is not None:
-            print("Cuisine exists for {}. Returning recipes from datastore.".format(cuisine_str))
+            _log.debug('Cuisine exists for %s. Returning recipes from datastore.', cuisine_str)
             # get recipes from datastore
             matching_recipes = []
             recipe_ids = []
@@ -157,7 +199,7 @@ class SousChef(threading.Thread):
                 recipe_ids.append(recipe['id'])
                 matching_recipes.append(recipe)
             if len(matching_recipes) < self.MAX_RECIPES:
-                recipes = json.loads(cuisine.get_property_value('detail'))
+                recipes = _json_loads(cuisine.get_property_value('detail'))
                 for recipe in recipes:
                     recipe_id = str(recipe['id'])
                     if recipe_id not in recipe_ids:
@@ -169,7 +211,7 @@ class SousChef(threading.Thread):
             self.recipe_store.record_cuisine_request_for_user(cuisine, state.user)
         else:
             # we don't have the cuisine in our datastore yet, so get list of recipes from Spoonacular
-            print("Cuisine does not exist for {}. Querying Spoonacular for recipes.".format(cuisine_str))
+            _log.debug('Cuisine does not exist for %s. Querying Spoonacular for recipes.', cuisine_str)
             matching_recipes = self.recipe_client.find_by_cuisine(cuisine_str)
             # add cuisine to datastore
             cuisine = self.recipe_store.add_cuisine(cuisine_str, matching_recipes, state.user)
@@ -182,9 +224,10 @@ class SousChef(threading.Thread):
         return response
 
     def handle_selection_message(self, state):
-        selection = -1
-        if state.conversation_context['selection'].isdigit():
-            selection = int(state.conversation_context['selection'])
+        try:
+            selection = int(state.conversation_context.get('selection', ''))
+        except ValueError:
+            selection = -1
         if 1 <= selection <= self.MAX_RECIPES:
             # we want to get a the recipe based on the selection
             # first we see if we already have the recipe in our datastore
@@ -192,15 +235,19 @@ class SousChef(threading.Thread):
             recipe_id = recipes[selection-1]['id']
             recipe = self.recipe_store.find_recipe(recipe_id)
             if recipe is not None:
-                print("Recipe exists for {}. Returning recipe steps from datastore.".format(recipe_id))
+                _log.debug('Recipe exists for %s. Returning recipe steps from datastore.', recipe_id)
                 recipe_detail = recipe.get_property_value('detail')
                 recipe_title = recipe.get_property_value('title')
                 # increment the count on the ingredient/cuisine-recipe and the user-recipe
                 self.recipe_store.record_recipe_request_for_user(recipe, state.ingredient_cuisine, state.user)
             else:
-                print("Recipe does not exist for {}. Querying Spoonacular for details.".format(recipe_id))
-                recipe_info = self.recipe_client.get_info_by_id(recipe_id)
-                recipe_steps = self.recipe_client.get_steps_by_id(recipe_id)
+                _log.debug('Recipe does not exist for %s. Querying Spoonacular for details.', recipe_id)
+                # the info and steps requests are independent, so issue them
+                # concurrently and pay only the slower of the two round trips
+                info_future = self.executor.submit(self.recipe_client.get_info_by_id, recipe_id)
+                steps_future = self.executor.submit(self.recipe_client.get_steps_by_id, recipe_id)
+                recipe_info = info_future.result()
+                recipe_steps = steps_future.result()
                 recipe_detail = self.get_recipe_instructions_response(recipe_info, recipe_steps)
                 recipe_title = recipe_info['title']
                 # add recipe to datastore
@@ -236,45 +283,44 @@ class SousChef(threading.Thread):
 
     @staticmethod
     def get_recipe_instructions_response(recipe_info, recipe_steps):
-        response = "Ok, it takes *" + \
-                   str(recipe_info['readyInMinutes']) + \
-                   "* minutes to make *" + \
-                   str(recipe_info['servings']) + \
-                   "* servings of *" + \
-                   recipe_info['title'] + "*. Here are the steps:\n\n"
+        parts = ["Ok, it takes *",
+                 str(recipe_info['readyInMinutes']),
+                 "* minutes to make *",
+                 str(recipe_info['servings']),
+                 "* servings of *",
+                 recipe_info['title'],
+                 "*. Here are the steps:\n\n"]
 
         if recipe_steps and recipe_steps[0]['steps']:
             for i, r_step in enumerate(recipe_steps[0]['steps']):
-                equip_str = ""
-                for e in r_step['equipment']:
-                    equip_str += e['name'] + ", "
-                if not equip_str:
-                    equip_str = "None"
-                else:
-                    equip_str = equip_str[:-2]
-                response += "*Step " + str(i + 1) + "*:\n" + \
-                            "_Equipment_: " + equip_str + "\n" + \
-                            "_Action_: " + r_step['step'] + "\n\n"
+                equip_str = ", ".join(e['name'] for e in r_step['equipment']) or "None"
+                parts += ["*Step ", str(i + 1), "*:\n",
+                          "_Equipment_: ", equip_str, "\n",
+                          "_Action_: ", r_step['step'], "\n\n"]
         else:
-            response += "_No instructions available for this recipe._\n\n"
+            parts.append("_No instructions available for this recipe._\n\n")
 
-        response += "*Say anything to me to start over...*"
-        return response
+        parts.append("*Say anything to me to start over...*")
+        return ''.join(parts)
 
     def run(self):
         self.recipe_store.init()
         while self.running:
             if self.slack_client.rtm_connect():
-                print("sous-chef is connected and running!")
+                _log.info('sous-chef is connected and running!')
+                websocket = self.slack_client.server.websocket
                 while self.running:
+                    # sleep in the kernel until a message arrives
+                    # (the timeout keeps stop() responsive while idle)
+                    select.select([websocket.sock], [], [], self.delay)
                     slack_output = self.slack_client.rtm_read()
                     message, message_sender, channel = self.parse_slack_output(slack_output)
                     if message and channel and message_sender != self.slack_bot_id:
                         self.handle_message(message, message_sender, channel)
-                    time.sleep(self.delay)
             else:
-                print("Connection failed. Invalid Slack token or bot ID?")
-        print("sous-chef shutting down...")
+                _log.error('Connection failed. Invalid Slack token or bot ID?')
+        _log.info('sous-chef shutting down...')
 
     def stop(self):
         self.running = False
+        self.executor.shutdown(wait=False)